@@ -1,31 +1,118 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Outputs: Calculated and read sha1 checksum in hex format
-# Usage: python git-convert-index.py
+# Usage: python3 git-convert-index.py
 # Read the index format with git-read-index-v5.py
 # read-index-v5 outputs the same format as git ls-files
 
+import array
 import hashlib
 import binascii
 import struct
-import os.path
-from collections import defaultdict
+import mmap
+import re
+import sys
+from collections import defaultdict, namedtuple
+from itertools import groupby
+from operator import attrgetter
+
+# Signature, version and number of entries of the index
+HEADER_STRUCT = struct.Struct("!4sII")
+# Stat data, SHA-1 and flags of an index entry, without the pathname
+STAT_DATA_STRUCT = struct.Struct("!IIIIIIIIII20sh")
+# Extended flags, following the flags of a v3 entry that has EXTENDED_FLAG set
+XTFLAGS_STRUCT = struct.Struct("!h")
+
+# flags, mode, mtime, stat crc and SHA-1 of an index-v5 file entry
+FILE_DATA_STRUCT = struct.Struct("!HHIII20s")
+# flags, foffset, cr, ncr, nsubtrees, nfiles, nentries and objname of an
+# index-v5 directory entry
+DIR_DATA_STRUCT = struct.Struct("!HIIIIIi20s")
+CRC_STRUCT = struct.Struct("!I")
+OFFSET_STRUCT = struct.Struct("!I")
+# Size of an extension, following its signature
+SIZE_STRUCT = struct.Struct("!I")
+# offset, ctime, ino, size, dev, uid and gid, which make up the stat crc
+STAT_CRC_STRUCT = struct.Struct("!IIIIIIII")
+# Placeholder for the directory data and crc, filled in at the end
+EMPTY_DIR_DATA = b"\0" * (DIR_DATA_STRUCT.size + CRC_STRUCT.size)
+
+# Bits of the on-disk entry flags: the stage is stored in bits 12-13 of
+# the v2/v3 flags and in bits 13-14 of the v5 flags, after assume-valid
+STAGE_SHIFT = 12
+STAGE_MASK = 0x3
+ASSUME_VALID_FLAG = 0x8000
+EXTENDED_FLAG = 0x4000
+STAGE_FLAGS = STAGE_MASK << STAGE_SHIFT
+
+# path, entry count and subtree count of a cache-tree entry
+TREE_ENTRY_RE = re.compile(b"([^\0]*)\0([^ ]*) ([^\n]*)\n")
+
+ENTRIES_FORMAT = b"""\
+  ctime: %d:%d
+  mtime: %d:%d
+  dev: %d\tino: %d
+  uid: %d\tgid: %d
+  size: %d\tflags: %x
+"""
+
+IndexEntry = namedtuple("IndexEntry", ["ctimesec", "ctimensec", "mtimesec",
+    "mtimensec", "dev", "ino", "mode", "uid", "gid", "filesize", "sha1",
+    "flags", "xtflags", "pathname", "filename"])
+# sha1 is None for invalidated cache-tree entries
+TreeExtensionData = namedtuple("TreeExtensionData", ["path", "entry_count",
+    "subtrees", "sha1"])
+# entry_modes and obj_names hold one item for each of the stages 1 to 3
+ReucExtensionData = namedtuple("ReucExtensionData", ["path", "entry_modes",
+    "obj_names"])
 
 #  fread {{{
 f = open(".git/index", "rb")
-filedata = list()
+filedata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+readpos = 0
 
 
 def fread(n):
-    global filedata
-    data = f.read(n)
-    filedata.append(data)
+    global readpos
+    data = filedata[readpos:readpos + n]
+    readpos += n
     return data
+
+
+def freadstruct(s):
+    global readpos
+    data = s.unpack_from(filedata, readpos)
+    readpos += s.size
+    return data
+
+
+def freadfields(delim, n):
+    global readpos
+    end = readpos
+    for i in range(n):
+        end = filedata.find(delim, end) + 1
+        if end == 0:
+            raise EOFError("Delimiter " + repr(delim) + " not found")
+    fields = filedata[readpos:end - 1].split(delim)
+    readpos = end
+    return fields
+
+
+def freadmatch(regex):
+    global readpos
+    match = regex.match(filedata, readpos)
+    if match is None:
+        raise EOFError("No match for " + repr(regex.pattern))
+    readpos = match.end()
+    return match.groups()
 # }}}
 
 
 # fwrite {{{
-fw = open(".git/index-v5", "wb")
+# The whole index is built in memory.  The offsets and directory data,
+# which are only known at the end, are patched in place, and the result
+# is written out with a single write by writeindex().
+fw = bytearray()
 writtenbytes = 0
 writtendata = list()
 
@@ -35,156 +122,141 @@ def fwrite(data):
     global writtendata
     writtendata.append(data)
     writtenbytes += len(data)
-    fw.write(data)
-# }}}
+    fw.extend(data)
+
 
+# Offset tables are collected in native array.array("I")s and turned
+# into their big-endian on-disk form in one go
+def packoffsets(offsets):
+    if sys.byteorder == "little":
+        offsets = array.array("I", offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
 
-# convert {{{
-def convert(n):
-    return str(struct.unpack('!I', n)[0])
+
+def writeindex():
+    with open(".git/index-v5", "wb") as f:
+        f.write(fw)
 # }}}
 
 
 # readheader {{{
 def readheader(f):
-    # Signature
-    signature = fread(4)
-    header = struct.unpack('!II', fread(8))
-    return dict({"signature": signature, "version": header[0], "nrofentries": header[1]})
+    (signature, version, nrofentries) = freadstruct(HEADER_STRUCT)
+    return dict({"signature": signature, "version": version, "nrofentries": nrofentries})
 # }}}
 
 
 # readindexentries {{{
 def readindexentries(f):
+    global readpos
     indexentries = []
-    conflictedentries = defaultdict(list)
+    conflictedentries = dict()
     paths = set()
+    # One pathname string per directory, shared by all entries in it
+    pathnames = dict()
     files = list()
-    filedirs = defaultdict(list)
-    byte = fread(1)
-    i = 0
+    filedirs = dict()
+    unpackstatdata = STAT_DATA_STRUCT.unpack_from
+    statdatasize = STAT_DATA_STRUCT.size
+    unpackxtflags = XTFLAGS_STRUCT.unpack_from
+    makeentry = IndexEntry._make
+    find = filedata.find
+    addfiledir = filedirs.setdefault
+    pos = readpos
     # Read index entries
-    while i < header["nrofentries"]:
-        entry = struct.unpack('!IIIIIIIIII', byte + fread(39))  # stat data
-        entry = entry + (str(binascii.hexlify(fread(20))),)     # SHA-1
-
-        if (header["version"] == 3):
-            entry = entry + struct.unpack('!hh', fread(4))      # Flags + extended flags
+    for i in range(header["nrofentries"]):
+        # stat data, SHA-1, flags
+        statdata = unpackstatdata(filedata, pos)
+        pos += statdatasize
+
+        # Only v3 entries with the extended flag set carry extended
+        # flags.  The padding is computed from the 62 or 64 bytes of
+        # fixed fields, respectively.
+        if statdata[-1] & EXTENDED_FLAG:
+            xtflags = unpackxtflags(filedata, pos)
+            pos += XTFLAGS_STRUCT.size
+            padbase = 7
         else:
-            entry = entry + struct.unpack('!h', fread(2))       # Flags
-
-        string = ""
-        byte = fread(1)
-        readbytes = 1
-        while byte != '\0':
-            string = string + byte
-            byte = fread(1)
-            readbytes += 1
-
-        pathname = os.path.dirname(string)
-        filename = os.path.basename(string)
+            xtflags = (0, )
+            padbase = 5
+
+        end = find(b'\0', pos)
+        if end == -1:
+            raise EOFError("Unterminated name in index entry")
+        string = filedata[pos:end]
+        readbytes = end + 1 - pos
+
+        # Index paths always use "/" as separator; top level files get
+        # an empty pathname
+        pathname, _, filename = string.rpartition(b"/")
+        pathname = pathnames.setdefault(pathname, pathname)
         paths.add(pathname)
         files.append(filename)
-        filedirs[pathname].append(filename)
-
-        entry = entry + (pathname, filename)           # Filename
+        addfiledir(pathname, []).append(filename)
 
-        if (header["version"] == 3):
-            dictentry = dict(zip(('ctimesec', 'ctimensec', 'mtimesec', 'mtimensec',
-                'dev', 'ino', 'mode', 'uid', 'gid', 'filesize', 'sha1', 'flags',
-                'xtflags', 'pathname', 'filename'), entry))
-        else:
-            dictentry = dict(zip(('ctimesec', 'ctimensec', 'mtimesec', 'mtimensec',
-                'dev', 'ino', 'mode', 'uid', 'gid', 'filesize', 'sha1', 'flags',
-                'pathname', 'filename'), entry))
-
-        if header["version"] == 2:
-            j = 8 - (readbytes + 5) % 8
-        else:
-            j = 8 - (readbytes + 1) % 8
+        entry = makeentry(statdata + xtflags + (pathname, filename))
 
-        while byte == '\0' and j > 0:
-            byte = fread(1)
-            j -= 1
+        # The nul byte terminating the name is part of the padding
+        pos = end + 8 - (readbytes + padbase) % 8
 
-        stage = (entry[11] & 0b0011000000000000) / 0b001000000000000
+        stage = (entry.flags >> STAGE_SHIFT) & STAGE_MASK
 
         if stage == 0:      # Not conflicted
-            indexentries.append(dictentry)
+            indexentries.append(entry)
         else:                   # Conflicted
             if stage == 1:  # Write the stage 1 entry to the main index, to avoid rewriting the whole index once the conflict is resolved
-                indexentries.append(dictentry)
-            conflictedentries[pathname].append(dictentry)
+                indexentries.append(entry)
+            conflictedentries.setdefault(pathname, []).append(entry)
 
-        i = i + 1
+    readpos = pos
 
-    return indexentries, conflictedentries, byte, paths, files, filedirs
+    # Sort the paths and entries once, every writer uses the same order.
+    # The index is sorted by full path, so the entries are already
+    # nearly in directory order and the (stable) sort is cheap.
+    indexentries.sort(key=attrgetter("pathname"))
+    return indexentries, conflictedentries, sorted(paths), files, filedirs
 # }}}
 
 
 # readextensiondata {{{
 def readextensiondata(f):
-    extensionsize = fread(4)
+    (extensionsize, ) = freadstruct(SIZE_STRUCT)
+    end = readpos + extensionsize
 
-    read = 0
     subtreenr = [0]
-    subtree = [""]
+    subtree = [b""]
     listsize = 0
     extensiondata = dict()
-    while read < int(convert(extensionsize)):
-        path = ""
-        byte = fread(1)
-        read += 1
-        while byte != '\0':
-            path += byte
-            byte = fread(1)
-            read += 1
+    while readpos < end:
+        (path, entry_count, subtrees) = freadmatch(TREE_ENTRY_RE)
 
         while listsize >= 0 and subtreenr[listsize] == 0:
             subtreenr.pop()
             subtree.pop()
             listsize -= 1
 
-        fpath = ""
+        fpath = b""
         if listsize > 0:
             for p in subtree:
-                if p != "":
-                    fpath += p + "/"
+                if p != b"":
+                    fpath += p + b"/"
             subtreenr[listsize] = subtreenr[listsize] - 1
-        fpath += path + "/"
-
-        entry_count = ""
-        byte = fread(1)
-        read += 1
-        while byte != " ":
-            entry_count += byte
-            byte = fread(1)
-            read += 1
-
-        subtrees = ""
-        byte = fread(1)
-        read += 1
-        while byte != "\n":
-            subtrees += byte
-            byte = fread(1)
-            read += 1
+        fpath += path + b"/"
 
         subtreenr.append(int(subtrees))
         subtree.append(path)
         listsize += 1
 
-        if entry_count != "-1":
-            sha1 = binascii.hexlify(fread(20))
-            read += 20
+        if entry_count != b"-1":
+            sha1 = fread(20)
         else:
-            sha1 = "invalid"
+            sha1 = None
 
-        if sha1 == "invalid":
-            extensiondata[fpath] = dict({"path": fpath, "entry_count": entry_count,
-            "subtrees": subtrees})
-        else:
-            extensiondata[fpath] = dict({"path": fpath, "entry_count": entry_count,
-            "subtrees": subtrees, "sha1": sha1})
+        # Keyed by the directory name used everywhere else, without the
+        # trailing slash
+        extensiondata[fpath[:-1]] = TreeExtensionData(fpath, entry_count,
+            subtrees, sha1)
 
     return extensiondata
 # }}}
@@ -192,44 +264,28 @@ def readextensiondata(f):
 
 # readreucextensiondata {{{
 def readreucextensiondata(f):
-    extensionsize = fread(4)
-
-    read = 0
-    extensiondata = defaultdict(list)
-    while read < int(convert(extensionsize)):
-        path = ""
-        byte = fread(1)
-        read += 1
-        while byte != '\0':
-            path += byte
-            byte = fread(1)
-            read += 1
-
-        entry_mode = list()
-        i = 0
-        while i < 3:
-            byte = fread(1)
-            read += 1
-            mode = ""
-            while byte != '\0':
-                mode += byte
-                byte = fread(1)
-                read += 1
-            i += 1
-
-            entry_mode.append(int(mode, 8))
-
-        i = 0
+    (extensionsize, ) = freadstruct(SIZE_STRUCT)
+    end = readpos + extensionsize
+
+    extensiondata = dict()
+    addentry = extensiondata.setdefault
+    while readpos < end:
+        # The path and the three octal modes
+        fields = freadfields(b'\0', 4)
+
+        path = fields[0]
+        entry_modes = tuple([int(mode, 8) for mode in fields[1:]])
+
         obj_names = list()
-        while i < 3:
-            if entry_mode[i] != 0:
+        for mode in entry_modes:
+            if mode != 0:
                 obj_names.append(fread(20))
-                read += 20
             else:
-                obj_names.append("")
-            i += 1
+                obj_names.append(b"")
 
-        extensiondata["/".join(path.split("/"))[:-1]].append(dict({"path": path, "entry_mode0": entry_mode[0], "entry_mode1": entry_mode[1], "entry_mode2": entry_mode[2], "obj_names0": obj_names[0], "obj_names1": obj_names[1], "obj_names2": obj_names[2]}))
+        # Grouped by directory, like the conflicted entries
+        addentry(path.rpartition(b"/")[0], []).append(
+            ReucExtensionData(path, entry_modes, tuple(obj_names)))
 
     return extensiondata
 
@@ -238,40 +294,55 @@ def readreucextensiondata(f):
 
 # printheader {{{
 def printheader(header):
-    print "Signature: " + header["signature"]
-    print "Version: " + str(header["version"])
-    print "Number of entries: " + str(header["nrofentries"])
+    print("Signature: " + header["signature"].decode())
+    print("Version: " + str(header["version"]))
+    print("Number of entries: " + str(header["nrofentries"]))
 # }}}
 
 
 # printindexentries {{{
 def printindexentries(indexentries):
+    out = list()
     for entry in indexentries:
-        if entry["pathname"] != "":
-            print entry["pathname"] + "/" + entry["filename"]
+        if entry.pathname != b"":
+            out.append(entry.pathname + b"/" + entry.filename + b"\n")
         else:
-            print entry["filename"]
-        print "  ctime: " + str(entry["ctimesec"]) + ":" + str(entry["ctimensec"])
-        print "  mtime: " + str(entry["mtimesec"]) + ":" + str(entry["mtimensec"])
-        print "  dev: " + str(entry["dev"]) + "\tino: " + str(entry["ino"])
-        print "  uid: " + str(entry["uid"]) + "\tgid: " + str(entry["gid"])
-        print "  size: " + str(entry["filesize"]) + "\tflags: " + "%x" % entry["flags"]
+            out.append(entry.filename + b"\n")
+        out.append(ENTRIES_FORMAT % (entry.ctimesec, entry.ctimensec,
+            entry.mtimesec, entry.mtimensec, entry.dev, entry.ino,
+            entry.uid, entry.gid, entry.filesize, entry.flags))
+    # Pathnames are bytes, write them out unchanged
+    sys.stdout.flush()
+    sys.stdout.buffer.write(b"".join(out))
 # }}}
 
 
 # {{{ printextensiondata
 def printextensiondata(extensiondata):
-    for entry in extensiondata.viewvalues():
-        print entry["sha1"] + " " + entry["path"] + " (" + entry["entry_count"] + " entries, " + entry["subtrees"] + " subtrees)"
+    # The keys are the directory names without the trailing slash, so
+    # this is the order of the index-v5 directories
+    for _, entry in sorted(extensiondata.items()):
+        if entry.sha1 is None:
+            sha1 = "invalid"
+        else:
+            sha1 = entry.sha1.hex()
+        print(sha1 + " " + entry.path.decode() + " (" + entry.entry_count.decode() + " entries, " + entry.subtrees.decode() + " subtrees)")
 # }}}
 
 
 # printreucextensiondata {{{
 def printreucextensiondata(extensiondata):
-    for e in extensiondata:
-        print "Path: " + e["path"]
-        print "Entrymode 1: " + str(e["entry_mode0"]) + " Entrymode 2: " + str(e["entry_mode1"]) + " Entrymode 3: " + str(e["entry_mode2"])
-        print "Objectnames 1: " + binascii.hexlify(e["obj_names0"]) + " Objectnames 2: " + binascii.hexlify(e["obj_names1"]) + " Objectnames 3: " + binascii.hexlify(e["obj_names2"])
+    out = list()
+    append = out.append
+    # The entries are grouped by directory
+    for d in sorted(extensiondata):
+        for e in extensiondata[d]:
+            (mode1, mode2, mode3) = e.entry_modes
+            (name1, name2, name3) = e.obj_names
+            append("Path: " + e.path.decode() + "\n")
+            append("Entrymode 1: " + str(mode1) + " Entrymode 2: " + str(mode2) + " Entrymode 3: " + str(mode3) + "\n")
+            append("Objectnames 1: " + name1.hex() + " Objectnames 2: " + name2.hex() + " Objectnames 3: " + name3.hex() + "\n")
+    sys.stdout.write("".join(out))
 # }}}
 
 
@@ -289,14 +360,14 @@ def writev5_0directories(paths, treeextensiondata):
     subtreenr = dict()
     # Calculate subtree numbers
     for p in sorted(paths, reverse=True):
-        splited = p.split("/")
+        splited = p.split(b"/")
         if p not in subtreenr:
             subtreenr[p] = 0
         if len(splited) > 1:
             i = 0
-            path = ""
+            path = b""
             while i < len(splited) - 1:
-                path += "/" + splited[i]
+                path += b"/" + splited[i]
                 i += 1
             if path[1:] not in subtreenr:
                 subtreenr[path[1:]] = 1
@@ -306,15 +377,15 @@ def writev5_0directories(paths, treeextensiondata):
     for p in paths:
         offsets[p] = writtenbytes
         fwrite(struct.pack("!Q", 0))
-        fwrite(p.split("/")[-1] + "\0")
-        p += "/"
-        if p in treeextensiondata:
-            fwrite(struct.pack("!ll", int(treeextensiondata[p]["entry_count"]), int(treeextensiondata[p]["subtrees"])))
-            if (treeextensiondata[p]["entry_count"] != "-1"):
-                fwrite(binascii.unhexlify(treeextensiondata[p]["sha1"]))
+        fwrite(p.split(b"/")[-1] + b"\0")
+        tree = treeextensiondata.get(p)
+        if tree is not None:
+            fwrite(struct.pack("!ll", int(tree.entry_count), int(tree.subtrees)))
+            if (tree.entry_count != b"-1"):
+                fwrite(tree.sha1)
 
         else:  # If there is no cache-tree data we assume the entry is invalid
-            fwrite(struct.pack("!ii", -1, subtreenr[p.strip("/")]))
+            fwrite(struct.pack("!ii", -1, subtreenr[p]))
     return offsets
 # }}}
 
@@ -325,7 +396,7 @@ def writev5_0files(files):
     for f in files:
         offsets[f] = writtenbytes
         fwrite(f)
-        fwrite("\0")
+        fwrite(b"\0")
     return offsets
 # }}}
 
@@ -333,20 +404,16 @@ def writev5_0files(files):
 # writev5_0fileentries {{{
 def writev5_0fileentries(entries, fileoffsets):
     offsets = dict()
-    for e in sorted(entries, key=lambda k: k['pathname']):
-        if e["pathname"] not in offsets:
-            offsets[e["pathname"]] = writtenbytes
-        fwrite(struct.pack("!IIIIIIIIII", e["ctimesec"], e["ctimensec"],
-            e["mtimesec"], e["mtimensec"], e["dev"], e["ino"], e["mode"],
-            e["uid"], e["gid"], e["filesize"]))
-        fwrite(binascii.unhexlify(e["sha1"]))
-
-        try:
-            fwrite(struct.pack("!III", e["flags"], e["xtflags"],
-                fileoffsets[e["filename"]]))
-        except KeyError:
-            fwrite(struct.pack("!III", e["flags"], 0,
-                fileoffsets[e["filename"]]))
+    for e in entries:
+        if e.pathname not in offsets:
+            offsets[e.pathname] = writtenbytes
+        fwrite(struct.pack("!IIIIIIIIII", e.ctimesec, e.ctimensec,
+            e.mtimesec, e.mtimensec, e.dev, e.ino, e.mode,
+            e.uid, e.gid, e.filesize))
+        fwrite(e.sha1)
+
+        fwrite(struct.pack("!III", e.flags, e.xtflags,
+            fileoffsets[e.filename]))
 
         writecrc32()
     return offsets
@@ -356,14 +423,11 @@ def writev5_0fileentries(entries, fileoffsets):
 # writev5_0fileoffsets {{{
 def writev5_0fileoffsets(diroffsets, fileoffsets, dircrcoffset):
     for d in sorted(diroffsets):
-        fw.seek(diroffsets[d])
-        fw.write(struct.pack("!Q", fileoffsets[d]))
+        struct.pack_into("!Q", fw, diroffsets[d], fileoffsets[d])
 
     # Calculate crc32
-    #f.seek(0)
-    #data = f.read(dircrcoffset)
-    fw.seek(dircrcoffset)
-    fw.write(struct.pack("!I", binascii.crc32(writtendata) & 0xffffffff))
+    struct.pack_into("!I", fw, dircrcoffset,
+            binascii.crc32(b"".join(writtendata)))
 
 # }}}
 
@@ -373,26 +437,25 @@ def writev5_0reucextensiondata(data):
     global writtenbytes
     offset = writtenbytes
     for d in data:
-        fwrite(d["path"])
-        fwrite("\0")
+        fwrite(d.path)
+        fwrite(b"\0")
         stages = set()
         fwrite(struct.pack("!b", 0))
-        for i in xrange(0, 2):
-            fwrite(struct.pack("!i", d["entry_mode" + str(i)]))
-            if d["entry_mode" + str(i)] != 0:
+        for i in range(0, 2):
+            fwrite(struct.pack("!i", d.entry_modes[i]))
+            if d.entry_modes[i] != 0:
                 stages.add(i)
 
         for i in sorted(stages):
-            fwrite(d["obj_names" + str(i)])
+            fwrite(d.obj_names[i])
     writecrc32()
-    fw.seek(20)
-    fw.write(struct.pack("!Q", offset))
+    struct.pack_into("!Q", fw, 20, offset)
 # }}}
 
 
 # writev5_0conflicteddata {{{
 def writev5_0conflicteddata(conflicteddata):
-    print "Not implemented yet"
+    print("Not implemented yet")
 # }}}
 
 # }}}
@@ -408,39 +471,39 @@ def writev5_1header(header, paths, files):
 
 # Write fake directory offsets which can only be filled in later {{{
 def writev5_1fakediroffsets(paths):
-    for p in paths:
-        fwrite(struct.pack("!I", 0))
+    fwrite(b"\0\0\0\0" * len(paths))
 # }}}
 
 
 # Write directories {{{
 def writev5_1directories(paths):
-    diroffsets = list()
+    diroffsets = array.array("I")
     dirwritedataoffsets = dict()
     dirdata = defaultdict(dict)
-    for p in sorted(paths):
-        diroffsets.append(writtenbytes)
+    adddiroffset = diroffsets.append
+    crc32 = binascii.crc32
+    for p in paths:
+        adddiroffset(writtenbytes)
 
         # pathname
-        if p == "":
-            fwrite("\0")
+        if p == b"":
+            name = b"\0"
         else:
-            fwrite(p + "/\0")
+            name = p + b"/\0"
 
-        dirwritedataoffsets[p] = writtenbytes
+        dirwritedataoffsets[p] = writtenbytes + len(name)
+        # The crc of the directory data covers the name as well
+        dirdata[p]["namecrc"] = crc32(name)
 
         # flags, foffset, cr, ncr, nsubtrees, nfiles, nentries, objname, dircrc
         # All this fields will be filled out when the rest of the index
         # is written
-        fwrite(struct.pack("!HIIIIIIIIIIII", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+        fwrite(name + EMPTY_DIR_DATA)
 
         # Subtreenr for later usage
-        if p != "":
-            path = p.split("/")
-            try:
-                dirdata["/".join(path[:-1])]["nsubtrees"] += 1
-            except KeyError:
-                dirdata["/".join(path[:-1])]["nsubtrees"] = 1
+        if p != b"":
+            parent = dirdata[p.rpartition(b"/")[0]]
+            parent["nsubtrees"] = parent.get("nsubtrees", 0) + 1
 
     return diroffsets, dirwritedataoffsets, dirdata
 # }}}
@@ -449,56 +512,54 @@ def writev5_1directories(paths):
 # Write fake file offsets {{{
 def writev5_1fakefileoffsets(indexentries):
     beginning = writtenbytes
-    for f in indexentries:
-        fwrite(struct.pack("!I", 0))
+    fwrite(b"\0\0\0\0" * len(indexentries))
     return beginning
 # }}}
 
 
 # Write directory offsets for real {{{
 def writev5_1diroffsets(offsets):
-    fw.seek(24)
-    for o in offsets:
-        fw.write(struct.pack("!I", o))
+    table = packoffsets(offsets)
+    fw[24:24 + len(table)] = table
 # }}}
 
 
 # Write file data {{{
 def writev5_1filedata(indexentries, dirdata):
-    global writtenbytes
     global writtendata
-    fileoffsets = list()
+    fileoffsets = array.array("I")
+    # The offsets and directories written so far aren't part of any crc
     writtendata = list()
-    for entry in sorted(indexentries, key=lambda k: k['pathname']):
-        offset = writtenbytes
-        fileoffsets.append(offset)
-        writtendata.append(struct.pack("!I", fw.tell()))
-        fwrite(entry["filename"] + "\0")
-
-        # Prepare flags
-        # TODO: Consider extended flags
-        flags = entry["flags"] & 0b1000000000000000
-        flags += (entry["flags"] & 0b0011000000000000) * 2
-        fwrite(struct.pack("!H", flags))
-
-        # mode
-        fwrite(struct.pack("!H", entry["mode"]))
-
-        # mtime
-        fwrite(struct.pack("!I", entry["mtimesec"]))
-        fwrite(struct.pack("!I", entry["mtimensec"]))
-
-        # calculate crc for stat data
-        crc = binascii.crc32(struct.pack("!IIIIIIII", offset, entry["ctimesec"], entry["ctimensec"], entry["ino"], entry["filesize"], entry["dev"], entry["uid"], entry["gid"]))
-        fwrite(struct.pack("!i", crc))
-
-        fwrite(binascii.unhexlify(entry["sha1"]))
-
-        writecrc32()
-        try:
-            dirdata[entry["pathname"]]["nfiles"] += 1
-        except KeyError:
-            dirdata[entry["pathname"]]["nfiles"] = 1
+    # The stat data is only needed for its crc, so it is packed into the
+    # same scratch buffer for every entry
+    statcrcdata = bytearray(STAT_CRC_STRUCT.size)
+    packstatcrc = STAT_CRC_STRUCT.pack_into
+    packfiledata = FILE_DATA_STRUCT.pack
+    packoffset = OFFSET_STRUCT.pack
+    crc32 = binascii.crc32
+    for pathname, entries in groupby(indexentries,
+            key=attrgetter("pathname")):
+        nfiles = 0
+        for entry in entries:
+            offset = writtenbytes
+            fileoffsets.append(offset)
+
+            # Prepare flags
+            # TODO: Consider extended flags
+            flags = ((entry.flags & ASSUME_VALID_FLAG) |
+                    ((entry.flags & STAGE_FLAGS) << 1))
+
+            # calculate crc for stat data
+            packstatcrc(statcrcdata, 0, offset, entry.ctimesec, entry.ctimensec, entry.ino, entry.filesize, entry.dev, entry.uid, entry.gid)
+            statcrc = crc32(statcrcdata)
+
+            # The crc of the entry covers its offset, which isn't written
+            fwritecrc32(entry.filename + b"\0" + packfiledata(flags,
+                entry.mode, entry.mtimesec, entry.mtimensec, statcrc,
+                entry.sha1), packoffset(offset))
+            nfiles += 1
+
+        dirdata[pathname]["nfiles"] = nfiles
 
     return fileoffsets, dirdata
 
@@ -507,167 +568,132 @@ def writev5_1filedata(indexentries, dirdata):
 
 # Write file offsets for read {{{
 def writev5_1fileoffsets(foffsets, fileoffsetbeginning):
-    fw.seek(fileoffsetbeginning)
-    for f in foffsets:
-        fw.write(struct.pack("!I", f))
+    table = packoffsets(foffsets)
+    fw[fileoffsetbeginning:fileoffsetbeginning + len(table)] = table
 # }}}
 
 
 # Write correct directory data {{{
-def writev5_1directorydata(dirdata, dirwritedataoffsets, fileoffsetbeginning):
-    global writtendata
+def writev5_1directorydata(paths, dirdata, treeextensiondata, dirwritedataoffsets, fileoffsetbeginning):
     foffset = fileoffsetbeginning
-    for d in sorted(dirdata.iteritems()):
-        try:
-            fw.seek(dirwritedataoffsets[d[0]])
-        except KeyError:
+    emptyobjname = b"\0" * 20
+    crc32 = binascii.crc32
+    for p in paths:
+        if p not in dirdata:
             continue
-        if d[0] == "":
-            writtendata = [d[0] + "\0"]
-        else:
-            writtendata = [d[0] + "/\0"]
-        try:
-            nsubtrees = d[1]["nsubtrees"]
-        except KeyError:
-            nsubtrees = 0
-
-        try:
-            nfiles = d[1]["nfiles"]
-        except KeyError:
-            nfiles = 0
-
-        try:
-            fwrite(struct.pack("!H", d[1]["flags"]))
-        except KeyError:
-            fwrite(struct.pack("!H", 0))
+        data = dirdata[p]
+        nsubtrees = data.get("nsubtrees", 0)
+        nfiles = data.get("nfiles", 0)
+        flags = data.get("flags", 0)
 
         if nfiles == -1 or nfiles == 0:
-            fwrite(struct.pack("!I", 0))
+            dirfoffset = 0
         else:
-            fwrite(struct.pack("!I", foffset))
+            dirfoffset = foffset
             foffset += (nfiles) * 4
 
-        try:
-            fwrite(struct.pack("!I", d[1]["cr"]))
-        except KeyError:
-            fwrite(struct.pack("!I", 0))
-
-        try:
-            fwrite(struct.pack("!I", d[1]["ncr"]))
-        except KeyError:
-            fwrite(struct.pack("!I", 0))
-
-        fwrite(struct.pack("!I", nsubtrees))
-        fwrite(struct.pack("!I", nfiles))
-
-        try:
-            fwrite(struct.pack("!i", d[1]["nentries"]))
-        except KeyError:
-            fwrite(struct.pack("!I", 0))
+        cr = data.get("cr", 0)
+        ncr = data.get("ncr", 0)
 
-        try:
-            fwrite(binascii.unhexlify(d[1]["objname"]))
-        except KeyError:
-            fwrite(struct.pack("!IIIII", 0, 0, 0, 0, 0))
-
-        writecrc32()
+        # The cache-tree data is taken straight from the TREE extension
+        tree = treeextensiondata.get(p)
+        if tree is None:
+            nentries = 0
+            objname = emptyobjname
+        else:
+            nentries = int(tree.entry_count)
+            if tree.sha1 is None:   # Cache tree entry invalid
+                objname = emptyobjname
+            else:
+                objname = tree.sha1
+
+        record = DIR_DATA_STRUCT.pack(flags, dirfoffset, cr, ncr,
+            nsubtrees, nfiles, nentries, objname)
+        # The name was written by writev5_1directories, which kept the
+        # crc of it to continue from
+        record += CRC_STRUCT.pack(crc32(record, data["namecrc"]))
+        offset = dirwritedataoffsets[p]
+        fw[offset:offset + len(record)] = record
 # }}}
 
 
 # Write conflicted data {{{
-def writev5_1conflicteddata(conflictedentries, reucdata, dirdata):
+def writev5_1conflicteddata(conflictedentries, dirdata):
     global writtenbytes
+    # TODO: The records below don't follow the index-v5 layout yet (one
+    # record per stage instead of per path, the stage modes and names
+    # aren't taken from the stages, and cr/ncr end up keyed by file
+    # instead of directory), so refuse rather than write corrupt data.
+    if conflictedentries:
+        raise NotImplementedError("Converting an index with conflicts "
+                "is not supported yet")
     for d in sorted(conflictedentries):
-        for f in d:
-            if d["pathname"] == "":
-                filename = d["filename"]
+        for f in conflictedentries[d]:
+            if f.pathname == b"":
+                filename = f.filename
             else:
-                filename = d["pathname"] + "/" + d["filename"]
+                filename = f.pathname + b"/" + f.filename
 
-            dirdata[filename]["cr"] = fw.tell()
-            try:
-                dirdata[filename]["ncr"] += 1
-            except KeyError:
-                dirdata[filename]["ncr"] = 1
+            dirdata[filename]["cr"] = writtenbytes
+            dirdata[filename]["ncr"] = dirdata[filename].get("ncr", 0) + 1
 
-            fwrite(d["pathname"] + d["filename"])
-            fwrite("\0")
+            fwrite(filename)
+            fwrite(b"\0")
             stages = set()
             fwrite(struct.pack("!b", 0))
-            for i in xrange(0, 2):
-                fwrite(struct.pack("!i", d["mode"]))
-                if d["mode"] != 0:
+            for i in range(0, 2):
+                fwrite(struct.pack("!i", f.mode))
+                if f.mode != 0:
                     stages.add(i)
 
             for i in sorted(stages):
-                print i
-                fwrite(binascii.unhexlify(d["sha1"]))
+                fwrite(f.sha1)
 
             writecrc32()
 
-        for f in reucdata[d]:
-            print f
-
     return dirdata
 # }}}
 
-
-# Compile cachetreedata and factor it into the dirdata
-def compilev5_1cachetreedata(dirdata, extensiondata):
-    for entry in extensiondata.iteritems():
-        dirdata[entry[1]["path"].strip("/")]["nentries"] = int(entry[1]["entry_count"])
-        try:
-            dirdata[entry[1]["path"].strip("/")]["objname"] = entry[1]["sha1"]
-        except:
-            pass  # Cache tree entry invalid
-
-        try:
-            if dirdata[entry[1]["path"].strip("/")]["nsubtrees"] != entry[1]["subtreenr"]:
-                print entry[0]
-                print dirdata[entry[1]["path"].strip("/")]["nsubtrees"]
-                print entry[1]["subtreenr"]
-        except KeyError:
-            pass
-
-    return dirdata
 # }}}
 
+
+# fwritecrc32 {{{
+# Write data followed by the crc32 of prefix + data, computed in one go
+def fwritecrc32(data, prefix=b""):
+    global writtenbytes
+    fw.extend(data)
+    fw.extend(CRC_STRUCT.pack(binascii.crc32(prefix + data)))
+    writtenbytes += len(data) + CRC_STRUCT.size
 # }}}
 
 
 # writecrc32 {{{
 def writecrc32():
     global writtendata
-    crc = binascii.crc32("".join(writtendata))
-    fwrite(struct.pack("!i", crc))
+    crc = binascii.crc32(b"".join(writtendata))
+    fwrite(CRC_STRUCT.pack(crc))
     writtendata = list()  # Reset writtendata for next crc32
 # }}}
 
 
 header = readheader(f)
 
-indexentries, conflictedentries, byte, paths, files, filedirs = readindexentries(f)
+indexentries, conflictedentries, paths, files, filedirs = readindexentries(f)
 
-filedata = filedata[:-1]
-ext = byte + f.read(3)
+ext = fread(4)
 extensiondata = []
 
-ext2 = ""
-if ext == "TREE":
-    filedata += ext
+ext2 = b""
+if ext == b"TREE":
     treeextensiondata = readextensiondata(f)
-    ext2 = f.read(4)
+    ext2 = fread(4)
 else:
     treeextensiondata = dict()
 
-if ext == "REUC" or ext2 == "REUC":
-    if ext == "REUC":
-        filedata += ext
-    else:
-        filedata += ext2
+if ext == b"REUC" or ext2 == b"REUC":
     reucextensiondata = readreucextensiondata(f)
 else:
-    reucextensiondata = list()
+    reucextensiondata = dict()
 
 # printheader(header)
 # printindexentries(indexentries)
@@ -675,20 +701,15 @@ else:
 # printreucextensiondata(reucextensiondata)
 
 
-if ext != "TREE" and ext != "REUC" and ext2 != "REUC":
-    sha1read = ext + f.read(16)
-elif ext2 != "REUC" and ext == "TREE":
-    sha1read = ext2 + f.read(16)
-else:
-    sha1read = f.read(20)
+# The checksum covers everything up to the trailing 20 byte SHA-1
+sha1read = filedata[-20:]
 
-print "SHA1 over the whole file: " + str(binascii.hexlify(sha1read))
+print("SHA1 over the whole file: " + sha1read.hex())
 
-sha1 = hashlib.sha1()
-sha1.update("".join(filedata))
-print "SHA1 over filedata: " + str(sha1.hexdigest())
+sha1 = hashlib.sha1(memoryview(filedata)[:-20])
+print("SHA1 over filedata: " + sha1.hexdigest())
 
-if sha1.hexdigest() == binascii.hexlify(sha1read):
+if sha1.digest() == sha1read:
     # Write v5_0 {{{
     # writev5_0header(header, paths, files)
     # diroffsets = writev5_0directories(sorted(paths), treeextensiondata)
@@ -712,11 +733,11 @@ if sha1.hexdigest() == binascii.hexlify(sha1read):
     fileoffsetbeginning = writev5_1fakefileoffsets(indexentries)
     # writecrc32() # TODO Check if needed
     fileoffsets, dirdata = writev5_1filedata(indexentries, dirdata)
-    dirdata = writev5_1conflicteddata(conflictedentries, reucextensiondata, dirdata)
+    dirdata = writev5_1conflicteddata(conflictedentries, dirdata)
     writev5_1diroffsets(diroffsets)
     writev5_1fileoffsets(fileoffsets, fileoffsetbeginning)
-    dirdata = compilev5_1cachetreedata(dirdata, treeextensiondata)
-    writev5_1directorydata(dirdata, dirwritedataoffsets, fileoffsetbeginning)
+    writev5_1directorydata(paths, dirdata, treeextensiondata, dirwritedataoffsets, fileoffsetbeginning)
     # }}}
+    writeindex()
 else:
-    print "File is corrupted"
+    print("File is corrupted")
@@ -1,6 +1,6 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-# Usage: python git-read-index-v5.py [-h] [-v] [--file=FILENAME]
+# Usage: python3 git-read-index-v5.py [-h] [-v] [--file=FILENAME]
 # The -h command line option shows the header of the index file
 # The -v command line option shows a more verbose file list
 # The --file command takes an argument, which file should be read.
@@ -13,28 +13,39 @@
 
 import struct
 import binascii
+import mmap
 import sys
-from collections import deque
+from collections import deque, namedtuple
 
 DIR_DATA_STRUCT = struct.Struct("!HIIIIII 20s")
 HEADER_STRUCT = struct.Struct("!IIII")
-CRC_STRUCT = struct.Struct("!i")
+CRC_STRUCT = struct.Struct("!I")
 OFFSET_STRUCT = struct.Struct("!I")
 FILE_DATA_STRUCT = struct.Struct("!HHIII 20s")
 
+FileEntry = namedtuple("FileEntry", ["name", "flags", "mode", "mtimes",
+    "mtimens", "statcrc", "objhash"])
+
+DirEntry = namedtuple("DirEntry", ["pathname", "flags", "foffset", "cr", "ncr",
+    "nsubtrees", "nfiles", "nentries", "objname"])
+
 HEADER_FORMAT = """\
 Signature: %(signature)s\t\t\tVersion: %(vnr)s
 Number of directories: %(ndir)s\tNumber of files: %(nfile)s
 Number of extensions: %(nextensions)s"""
 
-DIRECTORY_FORMAT = """\
-path: %(pathname)s flags: %(flags)s foffset: %(foffset)s
-ncr: %(ncr)s cr: %(cr)s nfiles: %(nfiles)s
-nentries: %(nentries)s objname: %(objname)s"""
+# Pathnames are bytes and are printed unchanged, so the formats that
+# include them are bytes as well
+# pathname, flags, foffset, ncr, cr, nfiles, nentries and objname
+DIRECTORY_FORMAT = b"""\
+path: %s flags: %d foffset: %d
+ncr: %d cr: %d nfiles: %d
+nentries: %d objname: %s"""
 
-FILES_FORMAT = """\
-%(name)s (%(objhash)s)\nmtime: %(mtimes)s:%(mtimens)s
-mode: %(mode)s flags: %(flags)s\nstatcrc: """
+# name, objhash, mtimes, mtimens, mode, flags and statcrc
+FILES_FORMAT = b"""\
+%s (%s)\nmtime: %d:%d
+mode: %d flags: %d\nstatcrc: %#x"""
 
 
 class SignatureError(Exception):
@@ -86,14 +97,15 @@ def read_header(f):
             HEADER_STRUCT.size, partialcrc)
     (vnr, ndir, nfile, nextensions) = HEADER_STRUCT.unpack(readheader)
 
-    if signature != "DIRC":
-        raise SignatureError("Signature is not DIRC. Signature: " + signature)
+    if signature != b"DIRC":
+        raise SignatureError("Signature is not DIRC. Signature: " +
+                repr(signature))
 
     if vnr != 5:
         raise VersionError("The index is not Version 5. Version: " + str(vnr))
 
     extoffsets = list()
-    for i in xrange(nextensions):
+    for i in range(nextensions):
         (readoffset, partialcrc) = read_calc_crc(f,
                 CRC_STRUCT.size, partialcrc)
         extoffsets.append(readoffset)
@@ -108,26 +120,30 @@ def read_header(f):
             nextensions=nextensions, extoffsets=extoffsets)
 
 
-def read_name(f, partialcrc=0):
-    """ Read a nul terminated name from the file
+def read_record(f, size, prefix=b""):
+    """ Read a nul terminated name followed by size bytes of fixed size data,
+    and calculate the crc code over both in one go
 
     Args:
-        f: the file from which the name should be read. The method will start
-            reading from where the file pointer in that file is at the moment.
-        partialcrc: A partial crc code of earlier read data, that should be
-            taken into account.
+        f: the mmap'ed index file from which the record should be read. The
+            method will start reading from where the file pointer in that file
+            is at the moment.
+        size: the size of the fixed size data following the name
+        prefix: data that is not part of the record in the file, but is
+            covered by its crc code
     Returns:
-        name, partialcrc: The name that was read and the crc code of the data
-            that was read, taking into account a partial crc code if there is
-            any.
+        name, data, datacrc: The name that was read, the fixed size data
+            following it and the packed crc code of prefix, name and data
     """
-    name = ""
-    (byte, partialcrc) = read_calc_crc(f, 1, partialcrc)
-    while byte != '\0':
-        name += byte
-        (byte, partialcrc) = read_calc_crc(f, 1, partialcrc)
+    start = f.tell()
+    end = f.find(b'\0', start)
+    if end == -1:
+        raise EOFError("Unterminated name at offset " + str(start))
+    namesize = end - start
+    record = f.read(namesize + 1 + size)
+    datacrc = CRC_STRUCT.pack(binascii.crc32(prefix + record))
 
-    return name, partialcrc
+    return record[:namesize], record[namesize + 1:], datacrc
 
 
 def read_index_entries(f, header):
@@ -148,7 +164,7 @@ def read_index_entries(f, header):
     # The foffset only needs to be considered for the first directory, since
     # we read the files continously and have the file pointer always in the
     # right place. Doing so saves 2 seeks per directory.
-    f.seek(directories[0]["foffset"])
+    f.seek(directories[0].foffset)
     (readoffset, partialcrc) = read_calc_crc(f, OFFSET_STRUCT.size)
     (offset, ) = OFFSET_STRUCT.unpack(readoffset)
     f.seek(offset)
@@ -166,7 +182,7 @@ def read_file(f, pathname):
         pathname: the pathname of the file, with which the filename is
             combined to get the full path
     Returns:
-        A dict with all filedata
+        A FileEntry with all filedata
     Raises:
         CrcError: The crc code in the index file doesn't match with the crc
             code of the read data.
@@ -175,21 +191,16 @@ def read_file(f, pathname):
     # The fileoffset is only read when really needed, in the other cases
     # it's just calculated from the file position, to save on reads and
     # simplify the code.
-    partialcrc = binascii.crc32(struct.pack("!I", f.tell()))
-
-    (filename, partialcrc) = read_name(f, partialcrc)
-
-    (statdata, partialcrc) = read_calc_crc(f, FILE_DATA_STRUCT.size,
-            partialcrc)
+    (filename, statdata, datacrc) = read_record(f, FILE_DATA_STRUCT.size,
+            OFFSET_STRUCT.pack(f.tell()))
     (flags, mode, mtimes, mtimens,
             statcrc, objhash) = FILE_DATA_STRUCT.unpack(statdata)
 
-    datacrc = CRC_STRUCT.pack(partialcrc)
     crc = f.read(CRC_STRUCT.size)
     if datacrc != crc:
-        raise CrcError("Wrong CRC for file entry: " + filename)
+        raise CrcError("Wrong CRC for file entry: " + repr(filename))
 
-    return dict(name=pathname + filename,
+    return FileEntry(name=pathname + filename,
             flags=flags, mode=mode, mtimes=mtimes, mtimens=mtimens,
             statcrc=statcrc, objhash=binascii.hexlify(objhash))
 
@@ -212,12 +223,12 @@ def read_files(f, directories, dirnr, files_out):
             function that calls read_files
     """
     queue = deque()
-    for i in xrange(directories[dirnr]["nfiles"]):
-        queue.append(read_file(f, directories[dirnr]["pathname"]))
+    for i in range(directories[dirnr].nfiles):
+        queue.append(read_file(f, directories[dirnr].pathname))
 
     while queue:
         if (len(directories) > dirnr + 1 and
-                queue[0]["name"] > directories[dirnr + 1]["pathname"]):
+                queue[0].name > directories[dirnr + 1].pathname):
             dirnr = read_files(f, directories, dirnr + 1, files_out)
         else:
             files_out.append(queue.popleft())
@@ -231,24 +242,20 @@ def read_dir(f):
     Args:
         f: The index file from which the directory data should be read
     Returns:
-        A dict with all file data
+        A DirEntry with all directory data
     Raises:
         CrcError: The crc code in the file doesn't match with the crc code
             of the data that was read
     """
-    (pathname, partialcrc) = read_name(f)
-
-    (readstatdata, partialcrc) = read_calc_crc(f, DIR_DATA_STRUCT.size,
-            partialcrc)
+    (pathname, readstatdata, datacrc) = read_record(f, DIR_DATA_STRUCT.size)
     (flags, foffset, cr, ncr, nsubtrees, nfiles,
             nentries, objname) = DIR_DATA_STRUCT.unpack(readstatdata)
 
-    datacrc = CRC_STRUCT.pack(partialcrc)
     crc = f.read(CRC_STRUCT.size)
     if crc != datacrc:
-        raise CrcError("Wrong crc for directory entry: " + pathname)
+        raise CrcError("Wrong crc for directory entry: " + repr(pathname))
 
-    return dict(pathname=pathname, flags=flags, foffset=foffset,
+    return DirEntry(pathname=pathname, flags=flags, foffset=foffset,
         cr=cr, ncr=ncr, nsubtrees=nsubtrees, nfiles=nfiles,
         nentries=nentries, objname=binascii.hexlify(objname))
 
@@ -263,27 +270,32 @@ def read_dirs(f, ndir):
         A list of all directories in the index file
     """
     dirs = list()
-    for i in xrange(ndir):
+    for i in range(ndir):
         dirs.append(read_dir(f))
 
     return dirs
 
 
 def print_header(header):
-    print(HEADER_FORMAT % header)
+    print(HEADER_FORMAT % dict(header, signature=header["signature"].decode()))
 
 
 def print_directories(directories):
-    for d in directories:
-        print (DIRECTORY_FORMAT % d)
+    out = [DIRECTORY_FORMAT % (d.pathname, d.flags, d.foffset, d.ncr, d.cr,
+        d.nfiles, d.nentries, d.objname) for d in directories]
+    if out:
+        sys.stdout.buffer.write(b"\n".join(out) + b"\n")
 
 
 def print_files(files, verbose=False):
-    for fi in files:
-        if verbose:
-            print (FILES_FORMAT % fi + hex(fi["statcrc"]))
-        else:
-            print fi["name"]
+    if verbose:
+        out = [FILES_FORMAT % (fi.name, fi.objhash, fi.mtimes, fi.mtimens,
+            fi.mode, fi.flags, fi.statcrc) for fi in files]
+    else:
+        out = [fi.name for fi in files]
+    # One write for the whole list instead of a print per file
+    if out:
+        sys.stdout.buffer.write(b"\n".join(out) + b"\n")
 
 
 def main(args):
@@ -301,6 +313,9 @@ def main(args):
     if not f:
         f = open(".git/index-v5", "rb")
 
+    # Names are found by searching the mapped file for their terminating nul
+    f = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
     header = read_header(f)
 
     files = read_index_entries(f, header)